@@ -356,6 +356,54 @@ filtersForm.addEventListener('submit', submitFiltersFormHandler);
 
 
 
+// find/<decl> and find/<decl>/src redirects
+// -----------------------------------------
+// There are no files at these URLs; they are served by the 404 page
+// (or by find/index.html), and find/map/<shard>.bmp tells us where to go.
+
+// must match `find_map_shards` and `find_map_shard` in print_docs.py
+const findMapShards = 256;
+
+function crc32(bytes) {
+  let crc = -1;
+  for (const b of bytes) {
+    crc ^= b;
+    for (let k = 0; k < 8; k++) {
+      crc = (crc >>> 1) ^ (0xEDB88320 & -(crc & 1));
+    }
+  }
+  return (crc ^ -1) >>> 0;
+}
+
+function findMapShard(decl) {
+  return (crc32(new TextEncoder().encode(decl)) % findMapShards).toString(16).padStart(2, '0');
+}
+
+async function redirectFind() {
+  const findPrefix = new URL(`${siteRoot}find/`, window.location.href).pathname;
+  const path = window.location.pathname;
+  if (!path.startsWith(findPrefix)) return false;
+
+  let decl = decodeURIComponent(path.slice(findPrefix.length)).replace(/\/(index\.html)?$/, '');
+  const src = decl.endsWith('/src');
+  if (src) decl = decl.slice(0, -'/src'.length);
+
+  const response = await fetch(`${siteRoot}find/map/${findMapShard(decl)}.bmp`);
+  if (!response.ok) return false;
+  const { modules, decls } = await response.json();
+  if (!Object.prototype.hasOwnProperty.call(decls, decl)) return false;
+
+  const [moduleId, line] = decls[decl];
+  const [pageUrl, srcUrl] = modules[moduleId];
+  if (src && srcUrl) {
+    // redirectTo is set in add_commit.js
+    redirectTo(`${srcUrl}#L${line}`);
+  } else {
+    window.location.replace(`${siteRoot}${pageUrl}#${decl}`);
+  }
+  return true;
+}
+
 // 404 page goodies
 // ----------------
 const suggestionsElmnt = document.getElementById('howabout');
@@ -367,16 +415,19 @@ if (suggestionsElmnt) {
     .appendChild(document.createElement('code'))
     .innerText = window.location.href.replace(/[/]/g, '/\u200b');
 
-  const query = window.location.href.match(/[/]([^/]+)(?:\.html|[/])?$/)[1];
-  searchIndexedData(query).then((results) => {
-    suggestionsElmnt.innerText = 'How about one of these instead:';
-    const ul = suggestionsElmnt.appendChild(document.createElement('ul'));
-    for (const { decl } of results) {
-      const li = ul.appendChild(document.createElement('li'));
-      const a = li.appendChild(document.createElement('a'));
-      a.href = `${siteRoot}find/${decl}`;
-      a.appendChild(document.createElement('code')).innerText = decl;
-    }
+  redirectFind().catch(() => false).then((redirected) => {
+    if (redirected) return;
+    const query = window.location.href.match(/[/]([^/]+)(?:\.html|[/])?$/)[1];
+    searchIndexedData(query).then((results) => {
+      suggestionsElmnt.innerText = 'How about one of these instead:';
+      const ul = suggestionsElmnt.appendChild(document.createElement('ul'));
+      for (const { decl } of results) {
+        const li = ul.appendChild(document.createElement('li'));
+        const a = li.appendChild(document.createElement('a'));
+        a.href = `${siteRoot}find/${decl}`;
+        a.appendChild(document.createElement('code')).innerText = decl;
+      }
+    });
   });
 }
 
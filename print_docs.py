@@ -16,28 +16,37 @@ import subprocess
 import toml
 import shutil
 import argparse
-import html
+import sys
 import gzip
-from urllib.parse import quote
-from functools import reduce
+import io
+import multiprocessing
+import zlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import lru_cache
+from itertools import chain
+from operator import itemgetter
 import textwrap
 from collections import Counter, defaultdict, namedtuple
 from pathlib import Path
-from typing import NamedTuple, List, Optional
-import sys
+from typing import NamedTuple, Dict, List, Optional, Tuple
 
 from mistletoe_renderer import CustomHTMLRenderer
 import pybtex.database
 from pybtex.style.labels.alpha import LabelStyle
 from pylatexenc.latex2text import LatexNodes2Text
-import networkx as nx
+try:
+  import orjson  # optional, much faster at parsing export.json
+except ImportError:
+  orjson = None
 
 root = os.getcwd()
 
 from jinja2 import Environment, FileSystemLoader, select_autoescape
 env = Environment(
     loader=FileSystemLoader('templates', 'utf-8'),
-    autoescape=select_autoescape(['html', 'xml'])
+    autoescape=select_autoescape(['html', 'xml']),
+    # templates don't change while the script runs; skip the mtime checks
+    auto_reload=False
 )
 env.globals['sorted'] = sorted
 
@@ -164,9 +173,10 @@ mathlib_github_src_root_with_commit = f"{mathlib_github_root}/blob/{mathlib_comm
 mathlib_github_src_root = f"{mathlib_github_root}/blob/master/src/"
 url_rewrites.append([mathlib_github_src_root, mathlib_github_src_root_with_commit])
 
-# The Lean version changes infrequently enough that we don't need to rewrite it
-lean_commit = subprocess.check_output(['lean', '--run', 'src/lean_commit.lean']).decode()
-lean_root = f'https://github.com/leanprover-community/lean/blob/{lean_commit}/library/'
+# set by `setup_lean` when run as a script. This module is also imported by
+# module page worker processes (see `init_module_worker`), which shouldn't start Lean themselves.
+lean_commit: Optional[str] = None
+path_info: List[Tuple[Path, str]] = []
 
 def get_name_from_leanpkg_path(p: Path) -> str:
   """ get the package name corresponding to a source path """
@@ -189,11 +199,22 @@ def get_name_from_leanpkg_path(p: Path) -> str:
 
   return '<unknown>'
 
-lean_paths = [
-  Path(p)
-  for p in json.loads(subprocess.check_output(['lean', '--path']).decode())['path']
-]
-path_info = [(p.resolve(), get_name_from_leanpkg_path(p)) for p in lean_paths]
+def setup_lean():
+  """ ask Lean for its commit and the directories it imports from """
+  global path_info
+  # The Lean version changes infrequently enough that we don't need to rewrite it
+  set_lean_commit(subprocess.check_output(['lean', '--run', 'src/lean_commit.lean']).decode())
+  lean_paths = [
+    Path(p)
+    for p in json.loads(subprocess.check_output(['lean', '--path']).decode())['path']
+  ]
+  path_info = [(p.resolve(), get_name_from_leanpkg_path(p)) for p in lean_paths]
+
+def set_lean_commit(commit: str):
+  global lean_commit
+  lean_commit = commit
+  env.globals['lean_commit'] = lean_commit
+  library_link_roots['core'] = f'https://github.com/leanprover-community/lean/blob/{lean_commit}/library/'
 
 class ImportName(NamedTuple):
   project: str
@@ -201,6 +222,7 @@ class ImportName(NamedTuple):
   raw_path: Path
 
   @classmethod
+  @lru_cache(maxsize=None)  # every declaration in a file has the same filename
   def of(cls, fname: str):
     fname = Path(fname)
     for p, name in path_info:
@@ -226,54 +248,38 @@ class ImportName(NamedTuple):
 
 env.globals['mathlib_github_root'] = mathlib_github_root
 env.globals['mathlib_commit'] = mathlib_commit
-env.globals['lean_commit'] = lean_commit
 env.globals['site_root'] = site_root
 
 markdown_renderer = CustomHTMLRenderer()
 
 def convert_markdown(ds):
+  # most declarations have no doc string; don't spin up the renderer for them
+  if not ds:
+    return ''
   return markdown_renderer.render_md(ds)
 
 # TODO: allow extending this for third-party projects
+# 'core' is added by `set_lean_commit`
 library_link_roots = {
-  'core': lean_root,
   'mathlib': mathlib_github_src_root,
 }
 
-def library_link(filename: ImportName, line=None):
-  try:
-    root = library_link_roots[filename.project]
-  except KeyError:
+@lru_cache(maxsize=None)
+def library_file_link(filename: ImportName) -> str:
+  root = library_link_roots.get(filename.project)
+  if root is None:
     return ""  # empty string is handled as a self-link
+  return root + '/'.join(filename.parts) + '.lean'
 
-  root += '/'.join(filename.parts) + '.lean'
-  if line is not None:
-    root += f'#L{line}'
-  return root
+def library_link(filename: ImportName, line=None):
+  link = library_file_link(filename)
+  if link and line is not None:
+    return f'{link}#L{line}'
+  return link
 
 env.globals['library_link'] = library_link
 env.filters['library_link'] = library_link
 
-def name_in_decl(decl_name, dmap):
-  if dmap['name'] == decl_name:
-    return True
-  if decl_name in [sf[0] for sf in dmap['structure_fields']]:
-    return True
-  if decl_name in [sf[0] for sf in dmap['constructors']]:
-    return True
-  return False
-
-def library_link_from_decl_name(decl_name, decl_loc, file_map):
-  try:
-    e = next(d for d in file_map[decl_loc] if name_in_decl(decl_name, d))
-  except StopIteration as e:
-    if decl_name[-3:] == '.mk':
-      return library_link_from_decl_name(decl_name[:-3], decl_loc, file_map)
-    print(f'{decl_name} appears in {decl_loc}, but we do not have data for that declaration. file_map:')
-    print(file_map[decl_loc])
-    raise e
-  return library_link(decl_loc, e['line'])
-
 def open_outfile(filename, mode = 'w'):
     filename = os.path.join(html_root, filename)
     os.makedirs(os.path.dirname(filename), exist_ok=True)
@@ -282,45 +288,82 @@ def open_outfile(filename, mode = 'w'):
 def separate_results(objs):
   file_map = defaultdict(list)
   loc_map = {}
+  # the line of the declaration each name belongs to
+  line_map = {}
   for obj in objs:
     # replace the filenames in-place with parsed filename objects
     i_name = obj['filename'] = ImportName.of(obj['filename'])
     if i_name.project == '.':
       continue  # this is doc-gen itself
     file_map[i_name].append(obj)
+    line = obj['line']
     loc_map[obj['name']] = i_name
+    line_map[obj['name']] = line
     for (cstr_name, tp) in obj['constructors']:
       loc_map[cstr_name] = i_name
+      line_map[cstr_name] = line
     for (sf_name, tp) in obj['structure_fields']:
       loc_map[sf_name] = i_name
+      line_map[sf_name] = line
     if len(obj['structure_fields']) > 0:
       loc_map[obj['name'] + '.mk'] = i_name
-  return file_map, loc_map
-
-def trace_deps(file_map):
-  graph = nx.DiGraph()
+      line_map[obj['name'] + '.mk'] = line
+  return file_map, loc_map, line_map
+
+def lean_deps(raw_path: Path) -> str:
+  """ the output of `lean --deps` for a single file """
+  proc = subprocess.Popen(['lean', '--deps', str(raw_path)], stdout=subprocess.PIPE)
+  out, _ = proc.communicate()
+  if proc.returncode != 0:
+    raise subprocess.CalledProcessError(proc.returncode, proc.args, out)
+  return out.decode()
+
+def trace_deps(file_map) -> Dict[ImportName, List[ImportName]]:
+  """ the import graph, as a map from each file to the files it imports """
+  graph = {}
   import_name_by_path = {k.raw_path: k for k in file_map}
   n = 0
   n_ok = 0
-  for k in file_map:
-    deps = subprocess.check_output(['lean', '--deps', str(k.raw_path)]).decode()
-    graph.add_node(k)
-    for p in deps.split():
-      n += 1
-      try:
-        p = import_name_by_path[Path(p).with_suffix('.lean')]
-      except KeyError:
-        print(f"trace_deps: Path not recognized: {p}")
-        continue
-      graph.add_edge(k, p)
-      n_ok += 1
+  # `lean --deps` prints the dependencies of all its arguments without saying
+  # which file they belong to, so we still need one process per file;
+  # run them concurrently instead, since each one is dominated by process startup.
+  with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+    all_deps = executor.map(lean_deps, [k.raw_path for k in file_map])
+    for k, deps in zip(file_map, all_deps):
+      graph[k] = []
+      for p in deps.split():
+        n += 1
+        try:
+          p = import_name_by_path[Path(p).with_suffix('.lean')]
+        except KeyError:
+          print(f"trace_deps: Path not recognized: {p}")
+          continue
+        if p not in graph[k]:
+          graph[k].append(p)
+        n_ok += 1
   print(f"trace_deps: Processed {n_ok} / {n} dependency links")
   return graph
 
+def reverse_graph(graph: Dict[ImportName, List[ImportName]]) -> Dict[ImportName, List[ImportName]]:
+  """ a map from each file to the files that import it """
+  rev = {k: [] for k in graph}
+  for k, ps in graph.items():
+    for p in ps:
+      rev[p].append(k)
+  return rev
+
 def load_json():
-  with open('export.json', 'r', encoding='utf-8') as f:
-    decls = json.load(f, strict=False)
-  file_map, loc_map = separate_results(decls['decls'])
+  with open('export.json', 'rb') as f:
+    data = f.read()
+  decls = None
+  if orjson is not None:
+    try:
+      decls = orjson.loads(data)
+    except orjson.JSONDecodeError:
+      pass  # e.g. raw control characters in strings, which need `strict=False` below
+  if decls is None:
+    decls = json.loads(data.decode('utf-8'), strict=False)
+  file_map, loc_map, line_map = separate_results(decls['decls'])
   for entry in decls['tactic_docs']:
     if len(entry['tags']) == 0:
       entry['tags'] = ['untagged']
@@ -332,33 +375,60 @@ def load_json():
       continue  # this is doc-gen itself
     file_map[i_name]
 
-  return file_map, loc_map, decls['notes'], mod_docs, decls['instances'], decls['tactic_docs']
+  return file_map, loc_map, line_map, decls['notes'], mod_docs, decls['instances'], decls['tactic_docs']
 
-def linkify_core(decl_name, text, loc_map):
-  if decl_name in loc_map:
+def mk_decl_urls(loc_map):
+  """ the full URL of every declaration, computed once rather than for every link """
+  page_urls = {i_name: site_root + i_name.url for i_name in set(loc_map.values())}
+  return {decl_name: f'{page_urls[i_name]}#{decl_name}' for decl_name, i_name in loc_map.items()}
+
+def linkify_core(decl_name, text, decl_urls):
+  url = decl_urls.get(decl_name)
+  if url is not None:
     tooltip = ' title="{}"'.format(decl_name) if text != decl_name else ''
-    return '<a href="{0}#{1}"{3}>{2}</a>'.format(
-      site_root + loc_map[decl_name].url, decl_name, text, tooltip)
+    return '<a href="{0}"{2}>{1}</a>'.format(url, text, tooltip)
   elif text != decl_name:
     return '<span title="{0}">{1}</span>'.format(decl_name, text)
   else:
     return text
 
-def linkify(string, loc_map):
-  return linkify_core(string, string, loc_map)
-
-def linkify_linked(string, loc_map):
-  return ''.join(
-    match[4] if match[0] == '' else
-    match[1] + linkify_core(match[0], match[2], loc_map) + match[3]
-    for match in re.findall(r'\ue000(.+?)\ue001(\s*)(.*?)(\s*)\ue002|([^\ue000]+)', string))
+def linkify(string, decl_urls):
+  return linkify_core(string, string, decl_urls)
+
+def linkify_linked(string, decl_urls):
+  """ linkify `\ue000name\ue001text\ue002` spans, leaving the rest of the string as is """
+  out = []
+  pos = 0
+  while True:
+    start = string.find('\ue000', pos)
+    if start < 0:
+      out.append(string[pos:])
+      break
+    out.append(string[pos:start])
+    # the name is nonempty, and the text ends at the first `\ue002` after it
+    mid = string.find('\ue001', start + 2)
+    end = string.find('\ue002', mid + 1) if mid >= 0 else -1
+    if end < 0:
+      # unmatched marker: drop it
+      pos = start + 1
+      continue
+    text = string[mid + 1:end]
+    stripped = text.strip()
+    if stripped:
+      leading = text[:len(text) - len(text.lstrip())]
+      trailing = text[len(text.rstrip()):]
+    else:
+      leading, trailing = text, ''
+    out.append(leading + linkify_core(string[start + 1:mid], stripped, decl_urls) + trailing)
+    pos = end + 1
+  return ''.join(out)
 
-def linkify_efmt(f, loc_map):
+def linkify_efmt(f, decl_urls):
   def go(f):
     if isinstance(f, str):
       f = f.replace('\n', ' ')
       # f = f.replace(' ', '&nbsp;')
-      return linkify_linked(f, loc_map)
+      return linkify_linked(f, decl_urls)
     elif f[0] == 'n':
       return f'<span class="fn">{go(f[1])}</span>'
     elif f[0] == 'c':
@@ -371,11 +441,31 @@ def linkify_efmt(f, loc_map):
 # store number of backref anchors and notes in each file
 num_backrefs = defaultdict(int)
 num_notes = defaultdict(int)
-
-def linkify_markdown(string: str, loc_map, bib) -> str:
+# module page worker processes can't add backrefs to this process's notes / bib entries,
+# so they set `queue_backrefs`, and send their (key, backref) pairs back to be added with `add_backrefs`
+queue_backrefs = False
+pending_note_backrefs = []
+pending_bib_backrefs = []
+
+def add_backrefs(note_backrefs, bib_backrefs, bib):
+  for key, backref in note_backrefs:
+    global_notes[key].backrefs.append(backref)
+  for key, backref in bib_backrefs:
+    bib.entries[key].backrefs.append(backref)
+
+code_token_separator = re.compile(r'([\s\[\]\(\)\{\}])')
+note_pattern = re.compile(r'Note \[(.*)\]', re.I)
+inline_code_pattern = re.compile(r'<code>([^<]+)</code>')
+highlighted_name_pattern = re.compile(r'<span class="n">([^<]+)</span>')
+# references (don't match if there are illegal characters for a BibTeX key,
+# cf. https://tex.stackexchange.com/a/408548)
+named_ref_pattern = re.compile(r'\[([^\]]+)\]\s*\[([^{ },~#%\\]+)\]')
+standalone_ref_pattern = re.compile(r'\[([^{ },~#%\\]+)\]')
+
+def linkify_markdown(string: str, linkify_name, bib) -> str:
   def linkify_type(string: str):
-    splitstr = re.split(r'([\s\[\]\(\)\{\}])', string)
-    tks = map(lambda s: linkify(s, loc_map), splitstr)
+    splitstr = code_token_separator.split(string)
+    tks = map(linkify_name, splitstr)
     return "".join(tks)
 
   def backref_title(filename: str):
@@ -388,17 +478,21 @@ def linkify_markdown(string: str, loc_map, bib) -> str:
     num_notes[current_filename] += 1
     backref_id = f'noteref{num_notes[current_filename]}'
     if current_project and current_project != 'test':
-      global_notes[key].backrefs.append(
-        (current_filename, backref_id, backref_title(current_filename))
-      )
+      backref = (current_filename, backref_id, backref_title(current_filename))
+      if queue_backrefs:
+        pending_note_backrefs.append((key, backref))
+      else:
+        global_notes[key].backrefs.append(backref)
     return backref_id
   def bib_backref(key: str) -> str:
     num_backrefs[current_filename] += 1
     backref_id = f'backref{num_backrefs[current_filename]}'
     if current_project and current_project != 'test':
-      bib.entries[key].backrefs.append(
-        (current_filename, backref_id, backref_title(current_filename))
-      )
+      backref = (current_filename, backref_id, backref_title(current_filename))
+      if queue_backrefs:
+        pending_bib_backrefs.append((key, backref))
+      else:
+        bib.entries[key].backrefs.append(backref)
     return backref_id
 
   def linkify_note(body: str, note: str) -> str:
@@ -417,56 +511,65 @@ def linkify_markdown(string: str, loc_map, bib) -> str:
     return body
 
   # notes
-  string = re.compile(r'Note \[(.*)\]', re.I).sub(
+  string = note_pattern.sub(
     lambda p: linkify_note(p.group(0), p.group(1)), string)
   # inline declaration names
-  string = re.sub(r'<code>([^<]+)</code>',
+  string = inline_code_pattern.sub(
     lambda p: f'<code>{linkify_type(p.group(1))}</code>', string)
   # declaration names in highlighted Lean code snippets
-  string = re.sub(r'<span class="n">([^<]+)</span>',
+  string = highlighted_name_pattern.sub(
     lambda p: f'<span class="n">{linkify_type(p.group(1))}</span>', string)
-  # references (don't match if there are illegal characters for a BibTeX key,
-  # cf. https://tex.stackexchange.com/a/408548)
-  string = re.sub(r'\[([^\]]+)\]\s*\[([^{ },~#%\\]+)\]',
+  # references
+  string = named_ref_pattern.sub(
     lambda p: linkify_named_ref(p.group(0), p.group(1), p.group(2)), string)
-  string = re.sub(r'\[([^{ },~#%\\]+)\]',
+  string = standalone_ref_pattern.sub(
     lambda p: linkify_standalone_ref(p.group(0), p.group(1)), string)
   return string
 
+summary_collapse_pattern = re.compile(r'([a-zA-Z`(),;\$\-]) *\n *([a-zA-Z`()\$])')
+# adapted from https://github.com/writeas/go-strip-markdown/blob/master/strip.go
+# Each pattern is paired with a substring that any match must contain (or None),
+# so that passes which cannot match are skipped with a cheap `in` test.
+# The passes can't be merged into a single regex, since later patterns apply
+# to the output of earlier ones.
+summary_remove_keep_contents_patterns = [(s, re.compile(p, re.MULTILINE)) for s, p in [
+  (None, r'(?m)^([\s\t]*)([\*\-\+]|\d\.)\s+'),
+  ('**', r'\*\*([^*]+)\*\*'),
+  ('*', r'\*([^*]+)\*'),
+  ('#', r'(?m)^\#{1,6}\s*([^#]+)\s*(\#{1,6})?$'),
+  ('__', r'__([^_]+)__'),
+  ('_', r'_([^_]+)_'),
+  ('![', r'\!\[(.*?)\]\s?[\[\(].*?[\]\)]'),
+  ('[', r'\[(.*?)\][\[\(].*?[\]\)]')
+]]
+summary_remove_patterns = [(s, re.compile(p, re.MULTILINE)) for s, p in [
+  ('>', r'^\s{0,3}>\s?'), ('==', r'^={2,}'), ('```', r'`{3}.*$'), ('~~', r'~~'),
+  (None, r'^[=\-]{2,}\s*$'), ('---', r'^-{3,}\s*$'), (None, r'^\s*')]]
+summary_end_of_line_pattern = re.compile(r'\s*\.?\n')
+
 def plaintext_summary(markdown, max_chars = 200):
   # collapse lines
-  text = re.compile(r'([a-zA-Z`(),;\$\-]) *\n *([a-zA-Z`()\$])').sub(r'\1 \2', markdown)
-
-  # adapted from https://github.com/writeas/go-strip-markdown/blob/master/strip.go
-  remove_keep_contents_patterns = [
-    r'(?m)^([\s\t]*)([\*\-\+]|\d\.)\s+',
-    r'\*\*([^*]+)\*\*',
-    r'\*([^*]+)\*',
-    r'(?m)^\#{1,6}\s*([^#]+)\s*(\#{1,6})?$',
-    r'__([^_]+)__',
-    r'_([^_]+)_',
-    r'\!\[(.*?)\]\s?[\[\(].*?[\]\)]',
-    r'\[(.*?)\][\[\(].*?[\]\)]'
-  ]
-  remove_patterns = [
-    r'^\s{0,3}>\s?', r'^={2,}', r'`{3}.*$', r'~~', r'^[=\-]{2,}\s*$',
-    r'^-{3,}\s*$', r'^\s*']
+  text = summary_collapse_pattern.sub(r'\1 \2', markdown)
 
-  text = reduce(lambda text, p: re.compile(p, re.MULTILINE).sub(r'\1', text), remove_keep_contents_patterns, text)
-  text = reduce(lambda text, p: re.compile(p, re.MULTILINE).sub('', text), remove_patterns, text)
+  for s, p in summary_remove_keep_contents_patterns:
+    if s is None or s in text:
+      text = p.sub(r'\1', text)
+  for s, p in summary_remove_patterns:
+    if s is None or s in text:
+      text = p.sub('', text)
 
   # collapse lines again
-  text = re.compile(r'\s*\.?\n').sub('. ', text)
+  text = summary_end_of_line_pattern.sub('. ', text)
 
   return textwrap.shorten(text, width = max_chars, placeholder="…")
 
-def link_to_decl(decl_name, loc_map):
-  return f'{site_root}{loc_map[decl_name].url}#{decl_name}'
-
 env.globals['kind_of_decl'] = lambda decl: decl['kind']
 
+# the same replacements as `html.escape`, in a single pass
+name_escape_table = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#x27;'})
+
 def htmlify_name(n):
-  return '.'.join([f'<span class="name">{ html.escape(part) }</span>' for part in n.split('.')])
+  return '<span class="name">' + '</span>.<span class="name">'.join(n.translate(name_escape_table).split('.')) + '</span>'
 env.filters['htmlify_name'] = htmlify_name
 
 # returns (pagetitle, intro_block), [(tactic_name, tactic_block)]
@@ -509,22 +612,30 @@ def write_pure_md_file(source, dest, name):
     ))
 
 def mk_site_tree(partition: List[ImportName]):
-  filenames = [ [filename.project] + list(filename.parts) for filename in partition ]
-  return mk_site_tree_core(filenames)
-
-def mk_site_tree_core(filenames, path=[]):
+  # build a trie in a single pass; each node is a pair (subdirectories, files)
+  tree = ({}, [])
+  for filename in partition:
+    *dirnames, basename = [filename.project] + list(filename.parts)
+    dirs, files = tree
+    for dirname in dirnames:
+      dirs, files = dirs.setdefault(dirname, ({}, []))
+    files.append(basename)
+  return mk_site_tree_core(tree)
+
+def mk_site_tree_core(tree, path=[]):
+  dirs, files = tree
   entries = []
 
-  for dirname in sorted(set(dirname for dirname, *rest in filenames if rest != [])):
+  for dirname in sorted(dirs):
     new_path = path + [dirname]
     entries.append({
       "kind": "project" if not path else "dir",
       "name": dirname,
       "path": '/'.join(new_path[1:]),
-      "children": mk_site_tree_core([rest for dn, *rest in filenames if rest != [] and dn == dirname], new_path)
+      "children": mk_site_tree_core(dirs[dirname], new_path)
     })
 
-  for filename in sorted(filename for filename, *rest in filenames if rest == []):
+  for filename in sorted(files):
     new_path = path + [filename]
     entries.append({
       "kind": "file",
@@ -535,14 +646,31 @@ def mk_site_tree_core(filenames, path=[]):
   return entries
 
 def setup_jinja_globals(file_map, loc_map, instances, bib):
-  env.globals['import_graph'] = trace_deps(file_map)
-  env.globals['site_tree'] = mk_site_tree(file_map)
+  """
+  Compute everything the templates need, set up `env` with it,
+  and return it so that worker processes can do the same with `set_jinja_globals`.
+  """
+  import_graph = trace_deps(file_map)
+  decl_urls = mk_decl_urls(loc_map)
+  # the same names (and tokens of code) are linkified over and over,
+  # so render the link for every declaration up front
+  decl_links = {decl_name: linkify(decl_name, decl_urls) for decl_name in decl_urls}
+  jinja_state = (import_graph, reverse_graph(import_graph), mk_site_tree(file_map),
+                 loc_map, instances, decl_urls, decl_links, bib)
+  set_jinja_globals(*jinja_state)
+  return jinja_state
+
+def set_jinja_globals(import_graph, reverse_import_graph, site_tree, loc_map, instances, decl_urls, decl_links, bib):
+  env.globals['import_graph'] = import_graph
+  env.globals['reverse_import_graph'] = reverse_import_graph
+  env.globals['site_tree'] = site_tree
   env.globals['instances'] = instances
   env.globals['import_options'] = lambda d, i: import_options(loc_map, d, i)
-  env.filters['linkify'] = lambda x: linkify(x, loc_map)
-  env.filters['linkify_efmt'] = lambda x: linkify_efmt(x, loc_map)
-  env.filters['convert_markdown'] = lambda x: linkify_markdown(convert_markdown(x), loc_map, bib) # TODO: this is probably very broken
-  env.filters['link_to_decl'] = lambda x: link_to_decl(x, loc_map)
+  linkify_name = lambda x: decl_links.get(x, x)
+  env.filters['linkify'] = linkify_name
+  env.filters['linkify_efmt'] = lambda x: linkify_efmt(x, decl_urls)
+  env.filters['convert_markdown'] = lambda x: linkify_markdown(convert_markdown(x), linkify_name, bib) # TODO: this is probably very broken
+  env.filters['link_to_decl'] = decl_urls.__getitem__
   env.filters['plaintext_summary'] = lambda x: plaintext_summary(x)
   env.filters['tex'] = lambda x: clean_tex(x)
 
@@ -552,11 +680,47 @@ current_filename: Optional[str] = None
 current_project: Optional[str] = None
 global_notes = {}
 GlobalNote = namedtuple('GlobalNote', ['md', 'backrefs'])
-def write_html_files(partition, loc_map, notes, mod_docs, instances, tactic_docs, bib):
-  global current_filename, current_project
+def add_global_notes(notes):
   for note_name, note_markdown in notes:
     global_notes[note_name] = GlobalNote(note_markdown, [])
 
+# (filename, items, decl_names) for each module page, set by `init_module_worker`
+module_pages = []
+
+def init_module_worker(pages, jinja_state, notes, lean_commit):
+  """
+  Set up a worker process for `write_module_file`.
+  When the worker is forked, this just reuses the parent's memory;
+  when it is spawned, the module is imported afresh and `env` needs its globals again.
+  """
+  global module_pages, queue_backrefs
+  module_pages = pages
+  queue_backrefs = True
+  set_lean_commit(lean_commit)
+  set_jinja_globals(*jinja_state)
+  add_global_notes(notes)
+
+def write_module_file(i):
+  """ render the page for the `i`th module, returning the backrefs found while doing so """
+  global current_filename, current_project
+  filename, items, decl_names = module_pages[i]
+  pending_note_backrefs.clear()
+  pending_bib_backrefs.clear()
+  with open_outfile(html_root + filename.url) as out:
+    current_project = filename.project
+    current_filename = filename.url
+    out.write(env.get_template('module.j2').render(
+      active_path = filename.url,
+      filename = filename,
+      items = items,
+      decl_names = decl_names,
+    ))
+  return list(pending_note_backrefs), list(pending_bib_backrefs)
+
+def write_html_files(partition, loc_map, notes, mod_docs, instances, tactic_docs, bib, jinja_state):
+  global current_filename, current_project
+  add_global_notes(notes)
+
   with open_outfile('index.html') as out:
     current_filename = 'index.html'
     current_project = None
@@ -580,17 +744,19 @@ def write_html_files(partition, loc_map, notes, mod_docs, instances, tactic_docs
         entries = sorted(entries, key = lambda n: n['name']),
         tagset = sorted(set(t for e in entries for t in e['tags']))))
 
-  for filename, decls in partition.items():
-    md = mod_docs.get(filename, [])
-    with open_outfile(html_root + filename.url) as out:
-      current_project = filename.project
-      current_filename = filename.url
-      out.write(env.get_template('module.j2').render(
-        active_path = filename.url,
-        filename = filename,
-        items = sorted(md + decls, key = lambda d: d['line']),
-        decl_names = sorted(d['name'] for d in decls),
-      ))
+  # module pages are independent of each other, and rendering them is the bulk of the work.
+  # Forking lets the workers share this process's memory, but it is only safe on Linux;
+  # elsewhere they are spawned and `init_module_worker` receives everything pickled, once per worker.
+  pages = [
+    (filename, sorted(chain(mod_docs.get(filename, ()), decls), key = itemgetter('line')),
+     sorted(map(itemgetter('name'), decls)))
+    for filename, decls in partition.items()]
+  start_method = 'fork' if sys.platform == 'linux' else 'spawn'
+  with ProcessPoolExecutor(mp_context=multiprocessing.get_context(start_method),
+                           initializer=init_module_worker,
+                           initargs=(pages, jinja_state, notes, lean_commit)) as executor:
+    for note_backrefs, bib_backrefs in executor.map(write_module_file, range(len(pages)), chunksize=32):
+      add_backrefs(note_backrefs, bib_backrefs, bib)
 
   current_project = 'extra'
   for (filename, displayname, source, _) in extra_doc_files:
@@ -630,19 +796,6 @@ def write_site_map(partition):
     for (filename, _, _, _) in extra_doc_files:
       out.write(site_root + filename + '.html\n')
 
-def write_docs_redirect(decl_name, decl_loc):
-  url = site_root + decl_loc.url
-  with open_outfile(f'find/{decl_name}/index.html') as out:
-    out.write(f'<meta http-equiv="refresh" content="0;url={url}#{quote(decl_name)}">')
-
-def write_src_redirect(decl_name, decl_loc, file_map):
-  url = library_link_from_decl_name(decl_name, decl_loc, file_map)
-  with open_outfile(f'find/{decl_name}/src/index.html') as out:
-    out.write(f"""<script src="{site_root}add_commit.js"></script>
-<script>redirectTo("{url}");</script>
-<noscript><a href="{url}">{decl_name} source</a></noscript>
-""")
-
 def write_add_commit_js(url_rewrites: List):
   """
   redirectTo in add_commit.js rewrites the tgt URL using the map
@@ -663,12 +816,38 @@ function redirectTo(tgt) {
 }
 """)
 
-def write_redirects(loc_map, file_map):
-  for decl_name in loc_map:
-    if (decl_name == 'con' or decl_name.startswith('con.')) and sys.platform == 'win32':
-      continue  # can't write these files on windows
-    write_docs_redirect(decl_name, loc_map[decl_name])
-    write_src_redirect(decl_name, loc_map[decl_name], file_map)
+# the number of files the find/ map is split into; must match `findMapShards` in nav.js
+find_map_shards = 256
+
+def find_map_shard(decl_name: str) -> str:
+  """ the find/map/<shard>.bmp file that `decl_name` is in; must match `findMapShard` in nav.js """
+  return '{:02x}'.format(zlib.crc32(decl_name.encode('utf-8')) % find_map_shards)
+
+def write_redirects(loc_map, line_map):
+  """
+  find/<decl> redirects to the documentation of <decl>, and find/<decl>/src to its source.
+  Rather than writing two tiny files for every declaration,
+  we write a map, split by a hash of the declaration name into `find_map_shards` small files,
+  that nav.js uses to do the redirect.
+  Those URLs are served by 404.html (e.g. on GitHub Pages),
+  or by find/index.html if the server rewrites find/* to it.
+  """
+  # each shard is {'modules': [[page url, source url]], 'decls': {decl_name: [module index, line]}}
+  shards = defaultdict(lambda: ({}, {'modules': [], 'decls': {}}))
+  for decl_name, decl_loc in loc_map.items():
+    module_ids, shard = shards[find_map_shard(decl_name)]
+    module_id = module_ids.get(decl_loc)
+    if module_id is None:
+      module_id = module_ids[decl_loc] = len(shard['modules'])
+      shard['modules'].append([decl_loc.url, library_link(decl_loc)])
+    shard['decls'][decl_name] = [module_id, line_map[decl_name]]
+  for shard_name, (_, shard) in shards.items():
+    # not a bitmap either, see `write_decl_txt`
+    with open_outfile(f'find/map/{shard_name}.bmp') as out:
+      json.dump(shard, out, separators=(',', ':'), check_circular=False)
+  with open_outfile('find/index.html') as out:
+    out.write(env.get_template('404.j2').render(
+      active_path=''))
 
 def copy_css_and_js(path, use_symlinks):
   def cp(a, b):
@@ -715,20 +894,26 @@ def mk_export_map_entry(decl_name, filename, kind, is_meta, line, args, tp):
 
 def mk_export_db(file_map):
   export_db = {}
+  decl_header_template = env.get_template('decl_header.j2')
   for _, decls in file_map.items():
     for obj in decls:
-      export_db[obj['name']] = mk_export_map_entry(obj['name'], obj['filename'], obj['kind'], obj['is_meta'], obj['line'], obj['args'], obj['type'])
-      export_db[obj['name']]['decl_header_html'] = env.get_template('decl_header.j2').render(decl=obj)
+      name = obj['name']
+      filename = obj['filename']
+      entry = mk_export_map_entry(name, filename, obj['kind'], obj['is_meta'], obj['line'], obj['args'], obj['type'])
+      export_db[name] = entry
+      # constructors and structure fields only differ from their declaration in `docs_link`
+      docs_page = f'{site_root}{filename.url}#'
       for (cstr_name, tp) in obj['constructors']:
-        export_db[cstr_name] = mk_export_map_entry(cstr_name, obj['filename'], obj['kind'], obj['is_meta'], obj['line'], [], tp)
+        export_db[cstr_name] = dict(entry, docs_link=docs_page + cstr_name)
       for (sf_name, tp) in obj['structure_fields']:
-        export_db[sf_name] = mk_export_map_entry(sf_name, obj['filename'],  obj['kind'], obj['is_meta'], obj['line'], [], tp)
+        export_db[sf_name] = dict(entry, docs_link=docs_page + sf_name)
+      entry['decl_header_html'] = decl_header_template.render(decl=obj)
   return export_db
 
 def write_export_db(export_db):
-  json_str = json.dumps(export_db)
-  with gzip.GzipFile(html_root + 'export_db.json.gz', 'w') as zout:
-    zout.write(json_str.encode('utf-8'))
+  with gzip.GzipFile(html_root + 'export_db.json.gz', 'wb', compresslevel=6) as zout:
+    with io.TextIOWrapper(zout, encoding='utf-8') as out:
+      json.dump(export_db, out, check_circular=False)
 
 def mk_export_searchable_map_entry(filename_name, name, description, kind = '', attributes = []):
   return {
@@ -740,41 +925,42 @@ def mk_export_searchable_map_entry(filename_name, name, description, kind = '',
   }
 
 def mk_export_searchable_db(file_map, tactic_docs):
-  export_searchable_db = []
-
   for fn, decls in file_map.items():
     filename_name = str(fn.url)
     for obj in decls:
-      decl_entry = mk_export_searchable_map_entry(filename_name, obj['name'], obj['doc_string'], obj['kind'], obj['attributes'])
-      export_searchable_db.append(decl_entry)
+      doc_string = obj['doc_string']
+      kind = obj['kind']
+      attributes = obj['attributes']
+      yield mk_export_searchable_map_entry(filename_name, obj['name'], doc_string, kind, attributes)
       for (cstr_name, _) in obj['constructors']:
-        cstr_entry = mk_export_searchable_map_entry(filename_name, cstr_name, obj['doc_string'], obj['kind'], obj['attributes'])
-        export_searchable_db.append(cstr_entry)
+        yield mk_export_searchable_map_entry(filename_name, cstr_name, doc_string, kind, attributes)
       for (sf_name, _) in obj['structure_fields']:
-        sf_entry = mk_export_searchable_map_entry(filename_name, sf_name, obj['doc_string'], obj['kind'], obj['attributes'])
-        export_searchable_db.append(sf_entry)
+        yield mk_export_searchable_map_entry(filename_name, sf_name, doc_string, kind, attributes)
 
   for tactic in tactic_docs:
     # category is the singular form of each docs webpage in 'General documentation'
     # e.g. 'tactic' -> 'tactics.html'
     tactic_entry_container_name = f"{tactic['category']}s.html"
-    tactic_entry = mk_export_searchable_map_entry(tactic_entry_container_name, tactic['name'], tactic['description'])
-    export_searchable_db.append(tactic_entry)
-
-  return export_searchable_db
+    yield mk_export_searchable_map_entry(tactic_entry_container_name, tactic['name'], tactic['description'])
 
 def write_export_searchable_db(searchable_data):
-  json_str = json.dumps(searchable_data)
+  """ write the entries as a JSON array, one at a time, without building the whole list """
   with open_outfile('searchable_data.bmp') as out:
-    out.write(json_str)
+    out.write('[')
+    for i, entry in enumerate(searchable_data):
+      if i:
+        out.write(', ')
+      out.write(json.dumps(entry, check_circular=False))
+    out.write(']')
 
 def main():
+  setup_lean()
   bib = parse_bib_file(f'{local_lean_root}docs/references.bib')
-  file_map, loc_map, notes, mod_docs, instances, tactic_docs = load_json()
-  setup_jinja_globals(file_map, loc_map, instances, bib)
+  file_map, loc_map, line_map, notes, mod_docs, instances, tactic_docs = load_json()
+  jinja_state = setup_jinja_globals(file_map, loc_map, instances, bib)
   write_decl_txt(loc_map)
-  write_html_files(file_map, loc_map, notes, mod_docs, instances, tactic_docs, bib)
-  write_redirects(loc_map, file_map)
+  write_html_files(file_map, loc_map, notes, mod_docs, instances, tactic_docs, bib, jinja_state)
+  write_redirects(loc_map, line_map)
   copy_css_and_js(html_root, use_symlinks=cl_args.l)
   copy_yaml_bib_files(html_root)
   copy_static_files(html_root)